@@ -0,0 +1,106 @@
+import numpy as np
+import pytest
+
+from tictactoe_gym.envs import TicTacToeEnv, BatchedTicTacToeEnv
+
+
+@pytest.mark.parametrize("dtype", [np.int8, np.uint8, np.int16, np.int32, np.int64])
+def test_batched_matches_single(dtype):
+    """
+    Random games stepped in a batch match the same games played one at a time.
+    """
+    rng = np.random.default_rng(0)
+    n = 200
+    batch = BatchedTicTacToeEnv(n)
+    singles = [TicTacToeEnv() for _ in range(n)]
+    for env in singles:
+        env.reset()
+    done = np.zeros(n, dtype = bool)
+
+    for _ in range(12):
+        actions = rng.integers(0, 9, n).astype(dtype)
+        observation, reward, terminated, _, _ = batch.step(actions)
+        for i, env in enumerate(singles):
+            if done[i]:
+                assert terminated[i]
+                continue
+            single_obs, single_reward, single_terminated, _, _ = env.step(int(actions[i]))
+            assert np.array_equal(observation[i], single_obs)
+            assert reward[i] == single_reward
+            assert terminated[i] == single_terminated
+            done[i] = single_terminated
+
+
+@pytest.mark.parametrize("dtype", [np.int8, np.uint8])
+def test_batched_step_last_cell_small_int(dtype):
+    """
+    A move on cell 8 is placed even when actions use a dtype too narrow for 1 << 8.
+    """
+    batch = BatchedTicTacToeEnv(1)
+    observation, _, _, _, _ = batch.step(np.array([8], dtype = dtype))
+
+    assert observation[0, 2, 2] == 1
+    assert batch.x_bits[0] == 1 << 8
+
+
+LINES = ((0, 1, 2), (3, 4, 5), (6, 7, 8), (0, 3, 6), (1, 4, 7), (2, 5, 8), (0, 4, 8), (2, 4, 6))
+
+def reference_result(board):
+    """
+    Check a flat board by summing every line.
+
+    Returns:
+    terminated (bool): True if a line is complete or the board is full.
+    result (int): 1 if player 1 wins, -1 if player 2 wins, 0 otherwise.
+    """
+    for line in LINES:
+        total = sum(board[i] for i in line)
+        if abs(total) == 3:
+            return True, total // 3
+    return all(board), 0
+
+
+def test_step_matches_reference_checker():
+    """
+    Random games, including moves on occupied cells, agree with a plain line-sum checker.
+    """
+    rng = np.random.default_rng(0)
+    env = TicTacToeEnv()
+    for _ in range(2000):
+        env.reset()
+        board = [0] * 9
+        player = 1
+        terminated = False
+        while not terminated:
+            action = int(rng.integers(0, 9))
+            if board[action] == 0:
+                board[action] = player
+            observation, reward, terminated, _, _ = env.step(action)
+            player = -player
+
+            assert np.array_equal(observation.reshape(9), board)
+            assert (terminated, reward) == reference_result(board)
+            assert env._terminal_and_result() == (terminated, reward)
+
+
+@pytest.mark.parametrize("actions, result", [
+    #Player 2 replays player 1's cells, so player 1 wins with three marks on the board
+    ([0, 0, 1, 1, 2], 1),
+    #Player 1 replays player 2's cells, so player 2 wins with four marks on the board
+    ([4, 0, 0, 1, 1, 2], -1),
+])
+def test_early_win_after_occupied_moves(actions, result):
+    """
+    A move on an occupied cell passes the turn, so a line can be completed before the fifth mark.
+    """
+    env = TicTacToeEnv()
+    env.reset()
+    for action in actions[:-1]:
+        _, reward, terminated, _, _ = env.step(action)
+        assert not terminated and reward == 0
+
+    _, reward, terminated, _, _ = env.step(actions[-1])
+
+    assert env.move_count < 5
+    assert terminated and reward == result
+    assert env._is_game_over() and env._result() == result
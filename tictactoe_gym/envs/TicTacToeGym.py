@@ -1,43 +1,221 @@
+import functools
+import os
+from multiprocessing import get_context
 import gym
 import pygame
 import numpy as np
 from gym import spaces
 
+#TODO: regenerate for size N. The masks and lookup tables below, and the literal 3s and 9s
+#throughout this module, are specialized for the 3x3 board.
+
+#Rows, columns and diagonals encoded as 9-bit masks
+WIN_MASKS = (0o700, 0o070, 0o007, 0o444, 0o222, 0o111, 0o421, 0o124)
+
+#Indices into WIN_MASKS of the lines passing through each cell
+_LINES_THROUGH = tuple(tuple(j for j, mask in enumerate(WIN_MASKS) if (mask >> i) & 1) for i in range(9))
+
+#Masks of the lines through each cell, padded to 4 columns by repeating the first line
+_LINE_MASKS_THROUGH = np.array(
+    [[WIN_MASKS[j] for j in (lines + lines[:1] * 4)[:4]] for lines in _LINES_THROUGH],
+    dtype = np.uint16)
+
+#Cell lookup table: row m holds a 1 in every cell whose bit is set in the 9-bit mask m
+_BITS_TO_CELLS = ((np.arange(512)[:, None] >> np.arange(9)) & 1).astype(np.int8)
+_BITS_TO_GRID = _BITS_TO_CELLS.reshape(512, 3, 3)
+
+#Cell permutations for the 8 board symmetries: identity, 3 rotations and 4 reflections
+_SYM_PERM = tuple(
+    tuple(3*r + c for r, c in (transform(i // 3, i % 3) for i in range(9)))
+    for transform in (
+        lambda r, c: (r, c),
+        lambda r, c: (c, 2 - r),
+        lambda r, c: (2 - r, 2 - c),
+        lambda r, c: (2 - c, r),
+        lambda r, c: (r, 2 - c),
+        lambda r, c: (2 - r, c),
+        lambda r, c: (c, r),
+        lambda r, c: (2 - c, 2 - r),
+    )
+)
+
+#Mask lookup tables: _SYM_BITS[k][m] is the 9-bit mask m moved by symmetry k
+_SYM_BITS = tuple(
+    tuple(sum(((m >> i) & 1) << perm[i] for i in range(9)) for m in range(512))
+    for perm in _SYM_PERM
+)
+
+@functools.lru_cache(maxsize = None)
+def _canonical_key(x_bits, o_bits):
+    """
+    Get the smallest (x_bits << 9) | o_bits over the 8 symmetries of a board.
+
+    Cached without a size limit since there are fewer than 3^9 boards.
+
+    Parameters:
+    x_bits (int): The 9-bit mask of cells held by player 1.
+    o_bits (int): The 9-bit mask of cells held by player 2.
+
+    Returns:
+    key (int): The canonical 18-bit key of the board.
+    """
+    return min((sym[x_bits] << 9) | sym[o_bits] for sym in _SYM_BITS)
+
+def _build_term_table():
+    """
+    Build the terminal/result table for every pair of masks.
+
+    Entry (x_bits << 9) | o_bits packs (terminal << 2) | (result + 1), where result is
+    1 if player 1 has won, -1 if player 2 has won and 0 otherwise.
+
+    Returns:
+    table (bytes): The packed table of 2^18 entries.
+    """
+    masks = np.arange(512)[:, None]
+    lines = np.array(WIN_MASKS)
+    wins = ((masks & lines) == lines).any(axis = 1)
+    keys = np.arange(1 << 18)
+    x_bits = keys >> 9
+    o_bits = keys & 0x1FF
+    x_win = wins[x_bits]
+    o_win = wins[o_bits]
+    terminal = x_win | o_win | ((x_bits | o_bits) == 0x1FF)
+    result = x_win.astype(np.int8) - o_win.astype(np.int8)
+    return ((terminal.astype(np.uint8) << 2) | (result + 1).astype(np.uint8)).tobytes()
+
+_TERM_TABLE = _build_term_table()
+
+def _advance(x_bits, o_bits, move_count, action, player_idx):
+    """
+    Play one move on a pair of bitboards.
+
+    A move on an occupied cell leaves the board unchanged.
+
+    Parameters:
+    x_bits (int): The 9-bit mask of cells held by player 1.
+    o_bits (int): The 9-bit mask of cells held by player 2.
+    move_count (int): The number of marks on the board.
+    action (int): The cell to play, 0 to 8.
+    player_idx (int): The player to move, 0 for player 1 and 1 for player 2.
+
+    Returns:
+    x_bits (int): The mask of player 1 after the move.
+    o_bits (int): The mask of player 2 after the move.
+    move_count (int): The number of marks on the board after the move.
+    reward (int): 1 if player 1 has won, -1 if player 2 has won, 0 otherwise.
+    terminated (bool): Whether the game is over after the move.
+    """
+    bit = 1 << action
+    if not (x_bits | o_bits) & bit:
+        if player_idx:
+            o_bits |= bit
+        else:
+            x_bits |= bit
+        move_count += 1
+
+    #No line can be completed with fewer than three marks on the board. This is not five
+    #because a move on an occupied cell still passes the turn, so one player may move twice
+    if move_count < 3:
+        return x_bits, o_bits, move_count, 0, False
+
+    packed = _TERM_TABLE[(x_bits << 9) | o_bits]
+    return x_bits, o_bits, move_count, (packed & 3) - 1, bool(packed & 4)
+
+def _get_actions(agent, states):
+    """
+    Ask an agent for one action per state.
+
+    Agents that define get_actions are given the whole batch, others are called with
+    get_action once per state.
+
+    Parameters:
+    agent (Agent): The agent to query.
+    states (ndarray): The flattened boards, shape (k, 9).
+
+    Returns:
+    actions (array-like): The k actions chosen by the agent.
+    """
+    if hasattr(agent, "get_actions"):
+        return agent.get_actions(states)
+    return [agent.get_action(state) for state in states]
+
 class TicTacToeEnv(gym.Env):
     """
     Tic-Tac-Toe Environment that follows Open AI Gym interface
-    
+
+    The board is stored as two 9-bit masks, x_bits for player 1 and o_bits for player 2,
+    where bit i is set when that player holds cell i (row major). The player to move is
+    kept as player_idx, 0 for player 1 and 1 for player 2.
     """
 
+    metadata = {"render_modes": ["human", "rgb_array"]}
+
     def __init__(self, render_mode = None, size = 3):
         """
         Initialize the environment with render mode and size.
 
         Parameters:
-        render_mode (str): The render mode, either "human" or None.
-        size (int): The size of the tic-tac-toe board. Currently only works with 3.
+        render_mode (str): The render mode, either "human", "rgb_array" or None.
+        size (int): The size of the tic-tac-toe board. Only 3 is supported.
         """
+        if size != 3:
+            raise ValueError(f"only size 3 is supported, got {size}")
+
         self.render_mode = render_mode
         self.window = None
         self.clock = None
 
-        #Currently will only work with default size but plan to extend to any size in future updates
         self.size = size
 
-        self.observation_space = spaces.Box(low = -1, high = 1, shape = (self.size * self.size,), dtype = int)
-        self.action_space = spaces.Discrete(size*size)
+        self.observation_space = spaces.Box(low = -1, high = 1, shape = (9,), dtype = np.int8)
+        self.action_space = spaces.Discrete(9)
         
-        self.state = np.zeros(9)
-        self.current_player = 1
+        self.x_bits = 0
+        self.o_bits = 0
+        self.move_count = 0
+        self.player_idx = 0
+
+    @property
+    def state(self):
+        """
+        The flattened board, 1 for player 1, -1 for player 2 and 0 for empty cells.
+
+        Returns:
+        state (ndarray): The board as an array of 9 elements.
+        """
+        return _BITS_TO_CELLS[self.x_bits] - _BITS_TO_CELLS[self.o_bits]
+
+    @property
+    def current_player(self):
+        """
+        The player to move, 1 for player 1 and -1 for player 2.
+
+        Returns:
+        current_player (int): The player to move.
+        """
+        return (1, -1)[self.player_idx]
+
+    def canonical_key(self):
+        """
+        Get a key shared by every board in the same symmetry class.
+
+        The key is the smallest (x_bits << 9) | o_bits over the 8 rotations and reflections
+        of the board. Agents that cache values per board can key on it so that symmetric
+        positions share a single entry.
+
+        Returns:
+        key (int): The canonical 18-bit key of the board.
+        """
+        return _canonical_key(self.x_bits, self.o_bits)
 
     def _get_obs(self):
         """
-        Get the observation (size x size) from the flattened state.
+        Get the observation (3 x 3) from the bitboards.
 
         Returns:
         observation (ndarray): The observation of the environment.
         """
-        return np.reshape(self.state, (-1,self.size))
+        return _BITS_TO_GRID[self.x_bits] - _BITS_TO_GRID[self.o_bits]
 
     def reset(self):
         """
@@ -46,15 +224,30 @@ class TicTacToeEnv(gym.Env):
         Returns:
         observation (ndarray): The observation of the environment.
         """
-        self.state = np.zeros(9)
+        self.x_bits = 0
+        self.o_bits = 0
+        self.move_count = 0
         observation = self._get_obs()
-        self.current_player = 1
+        self.player_idx = 0
 
         if self.render_mode == "human":
-            self._render_frame()
+            self.render()
 
         return observation
 
+    def _terminal_and_result(self):
+        """
+        Check if the game is over and get its result with a single table lookup.
+
+        Returns:
+        terminated (bool): True if the game is over, False otherwise.
+        result (int): 1 if player 1 wins, -1 if player 2 wins, 0 otherwise.
+        """
+        if self.move_count < 3:
+            return False, 0
+        packed = _TERM_TABLE[(self.x_bits << 9) | self.o_bits]
+        return bool(packed & 4), (packed & 3) - 1
+
     def _is_game_over(self):
         """
         Check if the game is over.
@@ -62,22 +255,7 @@ class TicTacToeEnv(gym.Env):
         Returns:
         result (bool): True if the game is over, False otherwise.
         """
-        for i in range(self.size):
-            if abs(np.sum(self.state[i*self.size:(i+1)*self.size])) == self.size:
-                return True
-            if abs(np.sum(self.state[i::self.size])) == self.size:
-                return True
-        #Check diagonals
-        if abs(np.sum(self.state[::self.size+1])) == self.size:
-            return True
-        if abs(np.sum(self.state[self.size-1:-self.size+1:self.size-1])) == self.size:
-            return True
-
-        #Check if game is a draw
-        if np.sum(np.abs(self.state)) == self.size*self.size:
-            return True
-
-        return False
+        return self._terminal_and_result()[0]
 
     def _result(self):
         """
@@ -86,16 +264,7 @@ class TicTacToeEnv(gym.Env):
         Returns:
         result (int): 1 if player 1 wins, -1 if player 2 wins, 0 if draw.
         """
-        if self._is_game_over():
-            if np.sum(np.abs(self.state)) == self.size*self.size:
-                return 0
-            else:
-                if self.current_player == 1:
-                    return 1
-                else:
-                    return -1
-        else:
-            return 0
+        return self._terminal_and_result()[1]
 
     def _get_info(self):
         return {"info": False }
@@ -114,17 +283,15 @@ class TicTacToeEnv(gym.Env):
         info (bool): Additional information, always False in this case.
         """
         
-        assert self.action_space.contains(action)
+        #Plain range check rather than action_space.contains, which is costly in tight loops
+        assert 0 <= action < 9, f"invalid action {action}"
         
-        if self.state[action] == 0:
-            self.state[action] = self.current_player
+        self.x_bits, self.o_bits, self.move_count, reward, terminated = _advance(
+            self.x_bits, self.o_bits, self.move_count, int(action), self.player_idx)
 
         observation = self._get_obs()
 
-        terminated = self._is_game_over()
-        reward = self._result()
-
-        self.current_player *= -1
+        self.player_idx ^= 1
 
         if self.render_mode == "human":
             self.render()
@@ -145,43 +312,110 @@ class TicTacToeEnv(gym.Env):
         result (int): 1 if player 1 wins, -1 if player 2 wins, 0 if draw.
         """
         self.reset()
-        while not self._is_game_over():
+        terminated = False
+        while not terminated:
             if self.current_player == 1:
                 action = agent1.get_action(self.state)
             else:
                 action = agent2.get_action(self.state)
-            self.step(action)
+            _, reward, terminated, _, _ = self.step(action)
 
             if render_mode == "human":
                 self.render()
                 
-        return self._result()
+        return reward
+
+    def run_many(self, agent1, agent2, n_games, batch_size = 256):
+        """
+        Run many games between two agents, up to batch_size games at a time.
+
+        The games are played in a BatchedTicTacToeEnv, so agents that define
+        get_actions(states) are called once per move with the (k, 9) states of the k
+        unfinished games and return k actions. Agents with only get_action are called
+        once per unfinished game on each move instead.
+
+        Parameters:
+        agent1 (Agent): The first agent to play the games.
+        agent2 (Agent): The second agent to play the games.
+        n_games (int): The number of games to play.
+        batch_size (int): The maximum number of games in flight at once.
+
+        Returns:
+        results (ndarray): For each game, 1 if player 1 wins, -1 if player 2 wins, 0 if draw.
+        """
+        results = np.zeros(n_games, dtype = np.int8)
+        batch = BatchedTicTacToeEnv()
+        for start in range(0, n_games, batch_size):
+            n = min(batch_size, n_games - start)
+            batch.reset(n)
+            actions = np.zeros(n, dtype = np.int64)
+            terminated = batch.terminated
+            ply = 0
+            #Every unfinished game in the batch has had the same number of turns,
+            #so the same agent is to move in all of them
+            while not terminated.all():
+                live = ~terminated
+                agent = agent1 if ply % 2 == 0 else agent2
+                actions[live] = _get_actions(agent, batch.state[live])
+                _, reward, terminated, _, _ = batch.step(actions)
+                ply += 1
+            results[start:start + n] = reward
+
+        return results
 
     def render(self, frame_rate = 0.5):
         """
         Render the current state of the environment in human-readable form.
+
+        The window is opened on the first call and stays open until close() is called.
+        Later calls only redraw the cells that changed since the previous frame. With the
+        "rgb_array" render mode the board is drawn to an off-screen surface instead, and
+        no window, event handling or frame rate limit is involved.
+
+        Returns:
+        frame (ndarray): The (300, 300, 3) RGB image in "rgb_array" mode, otherwise None.
         """
         if self.window is None:
-            pygame.init()
             width = 300
             height = 300
-            self.window = pygame.display.set_mode((width, height))
+            if self.render_mode == "rgb_array":
+                self.window = pygame.Surface((width, height))
+            else:
+                pygame.init()
+                self.window = pygame.display.set_mode((width, height))
+            self._build_sprites()
+            self.draw_grid()
+            self._drawn_bits = (0, 0)
+            dirty = [self.window.get_rect()]
+        else:
+            dirty = []
+
+        drawn_x, drawn_o = self._drawn_bits
+        dirty += self.draw_markers((self.x_bits ^ drawn_x) | (self.o_bits ^ drawn_o))
+        self._drawn_bits = (self.x_bits, self.o_bits)
+
+        if self.render_mode == "rgb_array":
+            return np.transpose(pygame.surfarray.array3d(self.window), (1, 0, 2))
             
         if self.clock is None:
             self.clock = pygame.time.Clock()
-           
-
-        self.draw_grid()
-        self.draw_markers()
 
         pygame.event.pump()
-        pygame.display.update()
+        pygame.display.update(dirty)
 
         self.clock.tick(frame_rate)
 
-        self.close()
+    def _build_sprites(self):
+        """
+        Draw the X and O markers once onto transparent cell-sized surfaces for blitting.
+        """
+        self._x_surf = pygame.Surface((100, 100), pygame.SRCALPHA)
+        pygame.draw.line(self._x_surf, (0,255,0), (85, 15), (15, 85), 10)
+        pygame.draw.line(self._x_surf, (0,255,0), (15, 15), (85, 85), 10)
+
+        self._o_surf = pygame.Surface((100, 100), pygame.SRCALPHA)
+        pygame.draw.circle(self._o_surf, (255,0,0), (50, 50), 40, 10)
 
-        
     def draw_grid(self):
         """
         Draw the tic-tac-toe grid on the pygame window.
@@ -194,23 +428,32 @@ class TicTacToeEnv(gym.Env):
             pygame.draw.line(self.window, grid, (0, x*100), (300, x*100), 3)
             pygame.draw.line(self.window, grid, (x*100, 0), (x*100, 300), 3)
 
-    def draw_markers(self):
+    def draw_markers(self, cells = 0x1FF):
         """
         Draw the markers for the current state on the tic-tac-toe board.
 
         Markers for player 1 (X) will be green and markers for player 2 (O) will be red.
+        Each redrawn cell is cleared first, leaving the grid lines untouched.
+
+        Parameters:
+        cells (int): The 9-bit mask of cells to redraw, all cells by default.
+
+        Returns:
+        rects (list): The areas of the window that were redrawn.
         """
-        x_pos = 0
-        for x in self._get_obs():
-            y_pos = 0
-            for y in x:
-                if y == 1:
-                    pygame.draw.line(self.window, (0,255,0), (y_pos*100 + 85, x_pos*100 + 15), ( y_pos*100 + 15,x_pos*100 + 85),10)
-                    pygame.draw.line(self.window, (0,255,0), (y_pos*100 + 15, x_pos*100 + 15), (y_pos*100 + 85,x_pos*100 + 85),10)
-                if y == -1:
-                    pygame.draw.circle(self.window, (255,0,0), (y_pos*100 + 50, x_pos*100 + 50), 40, 10)
-                y_pos += 1        
-            x_pos += 1
+        bg = (255, 255, 255)
+        redraw = _BITS_TO_GRID[cells] == 1
+        grid = self._get_obs()
+
+        rects = [pygame.Rect(y_pos*100 + 5, x_pos*100 + 5, 90, 90) for x_pos, y_pos in np.argwhere(redraw)]
+        for rect in rects:
+            self.window.fill(bg, rect)
+
+        self.window.blits(
+            [(self._x_surf, (y_pos*100, x_pos*100)) for x_pos, y_pos in np.argwhere(redraw & (grid == 1))]
+            + [(self._o_surf, (y_pos*100, x_pos*100)) for x_pos, y_pos in np.argwhere(redraw & (grid == -1))],
+            doreturn = False)
+        return rects
 
     def close(self):
         """
@@ -220,3 +463,160 @@ class TicTacToeEnv(gym.Env):
             pygame.quit()
             self.window = None
             self.clock = None
+
+
+class BatchedTicTacToeEnv:
+    """
+    A batch of independent Tic-Tac-Toe games stepped together with numpy.
+
+    Every game follows the same rules as TicTacToeEnv. The boards are stored as two uint16
+    arrays of 9-bit masks, x_bits for player 1 and o_bits for player 2, so a step over the
+    whole batch is a handful of vectorized operations. Only the lines through the cell
+    just played are checked, and only on the mover's board, since no other line can have
+    been completed by the move.
+    """
+
+    def __init__(self, n = 1):
+        """
+        Initialize the batch.
+
+        Parameters:
+        n (int): The number of games in the batch.
+        """
+        self.reset(n)
+
+    @property
+    def state(self):
+        """
+        The flattened boards, 1 for player 1, -1 for player 2 and 0 for empty cells.
+
+        Returns:
+        state (ndarray): The boards as an array of shape (n, 9).
+        """
+        return _BITS_TO_CELLS[self.x_bits] - _BITS_TO_CELLS[self.o_bits]
+
+    def _get_obs(self):
+        """
+        Get the observations (n x 3 x 3) from the bitboards.
+
+        Returns:
+        observation (ndarray): The observations of the games.
+        """
+        return _BITS_TO_GRID[self.x_bits] - _BITS_TO_GRID[self.o_bits]
+
+    def reset(self, n = None):
+        """
+        Reset every game in the batch.
+
+        Parameters:
+        n (int): The number of games, defaults to the current batch size.
+
+        Returns:
+        observation (ndarray): The observations of the games.
+        """
+        if n is not None:
+            self.n = n
+        self.x_bits = np.zeros(self.n, dtype = np.uint16)
+        self.o_bits = np.zeros(self.n, dtype = np.uint16)
+        self.current_player = np.ones(self.n, dtype = np.int8)
+        self.winner = np.zeros(self.n, dtype = np.int8)
+        self.terminated = np.zeros(self.n, dtype = bool)
+
+        return self._get_obs()
+
+    def step(self, actions):
+        """
+        Take one step in every game of the batch.
+
+        Moves on occupied cells are ignored as in TicTacToeEnv, and games that have already
+        terminated are left untouched.
+
+        Parameters:
+        actions (numpy.ndarray): The action for each game, shape (n,).
+
+        Returns:
+        observation (numpy.ndarray): The observations of the games after taking the actions.
+        reward (numpy.ndarray): 1 where player 1 has won, -1 where player 2 has won, 0 otherwise.
+        terminated (numpy.ndarray): Whether each game is terminated or not.
+        truncated (numpy.ndarray): Always False.
+        info (dict): Additional information, always False in this case.
+        """
+        actions = np.asarray(actions, dtype = np.intp)
+        assert actions.shape == (self.n,) and ((actions >= 0) & (actions < 9)).all()
+
+        bit = np.left_shift(1, actions).astype(np.uint16)
+        live = ~self.terminated
+        legal = live & (((self.x_bits | self.o_bits) & bit) == 0)
+        x_move = legal & (self.current_player == 1)
+        o_move = legal & (self.current_player == -1)
+        self.x_bits[x_move] |= bit[x_move]
+        self.o_bits[o_move] |= bit[o_move]
+
+        mover_bits = np.where(self.current_player == 1, self.x_bits, self.o_bits)
+        lines = _LINE_MASKS_THROUGH[actions]
+        won = legal & ((mover_bits[:, None] & lines) == lines).any(axis = 1)
+        self.winner[won] = self.current_player[won]
+        draw = (self.x_bits | self.o_bits) == 0x1FF
+
+        reward = self.winner.copy()
+        self.terminated = (self.winner != 0) | draw
+        self.current_player[live] *= -1
+
+        observation = self._get_obs()
+        truncated = np.zeros(self.n, dtype = bool)
+
+        return observation, reward, self.terminated.copy(), truncated, {"info": False}
+
+
+def _play_shard(args):
+    """
+    Play a shard of games in a worker process.
+
+    Parameters:
+    args (tuple): The two agent factories, the number of games to play and the seeds
+    passed to each factory.
+
+    Returns:
+    results (ndarray): For each game, 1 if player 1 wins, -1 if player 2 wins, 0 if draw.
+    """
+    agent1_factory, agent2_factory, n_games, seed1, seed2 = args
+    return TicTacToeEnv().run_many(agent1_factory(seed1), agent2_factory(seed2), n_games)
+
+def parallel_run(agent1_factory, agent2_factory, n_games, n_workers = None, seed = None):
+    """
+    Run games between two agents spread over several processes.
+
+    The games are split into one shard per worker. Each worker builds its own agents by
+    calling the factories, plays its shard with TicTacToeEnv.run_many and sends back only
+    the array of results. The factories must be picklable, e.g. module-level functions
+    or classes, since workers are started with the "spawn" method. For the same reason
+    the calling script must guard its entry point with if __name__ == "__main__":, as
+    each worker re-imports the main module.
+
+    Each factory is called with an int seed, distinct for every agent in every shard and
+    derived from seed, so seeded agents play different games in each shard and a run
+    can be reproduced by passing the same seed and n_workers.
+
+    Parameters:
+    agent1_factory (callable): Takes a seed and returns the first agent to play the games.
+    agent2_factory (callable): Takes a seed and returns the second agent to play the games.
+    n_games (int): The number of games to play.
+    n_workers (int): The number of worker processes, defaults to the number of CPUs.
+    seed (int): The seed the agent seeds are derived from, fresh entropy if None.
+
+    Returns:
+    results (ndarray): For each game, 1 if player 1 wins, -1 if player 2 wins, 0 if draw.
+    """
+    if n_workers is None:
+        n_workers = os.cpu_count() or 1
+    #No point starting interpreters for empty shards
+    n_workers = max(1, min(n_workers, n_games))
+    shards = [n_games // n_workers + (i < n_games % n_workers) for i in range(n_workers)]
+    seeds = np.random.SeedSequence(seed).generate_state(2 * n_workers).tolist()
+
+    with get_context("spawn").Pool(n_workers) as pool:
+        results = pool.map(_play_shard, [
+            (agent1_factory, agent2_factory, n, seeds[2*i], seeds[2*i + 1])
+            for i, n in enumerate(shards)])
+
+    return np.concatenate(results)
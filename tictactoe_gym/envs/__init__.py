@@ -1 +1 @@
-from tictactoe_gym.envs.TicTacToeGym import TicTacToeEnv
\ No newline at end of file
+from tictactoe_gym.envs.TicTacToeGym import TicTacToeEnv, BatchedTicTacToeEnv, parallel_run
\ No newline at end of file